@@ -0,0 +1 @@
+# Makes server.py importable from the tests directory.
@@ -1,38 +1,799 @@
 import argparse
-from flask import Flask, request, jsonify
-from flask.logging import create_logger
-from mlx_lm import load, generate
+import hashlib
+import logging
+import os
+import queue
+import re
+import shutil
+import struct
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from functools import lru_cache
+from pathlib import Path
+import fastjsonschema
+import mlx.core as mx
+import numpy as np
+import orjson
+from cachetools import TTLCache
+from flask import Flask, Response, request, jsonify, stream_with_context
+from flask.json.provider import DefaultJSONProvider
+from flask.logging import create_logger, default_handler
+from werkzeug.exceptions import HTTPException
+from mlx_lm import load, generate, stream_generate
+from mlx_lm.generate import BatchGenerator
+from mlx_lm.models.cache import make_prompt_cache, trim_prompt_cache
+from mlx_lm.sample_utils import make_sampler
+from mlx_lm.utils import get_model_path, load_config
+from rank_bm25 import BM25Okapi
+
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    JSON provider backed by orjson, which parses and serializes large payloads
+    (long conversations, RAG documents, generated text) several times faster.
+    """
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=self.default), mimetype=self.mimetype)
+
+class JSONFormatter(logging.Formatter):
+    """
+    Format log records as single-line JSON objects.
+    """
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return orjson.dumps(entry).decode()
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 logger = create_logger(app)
 
-def validate_temperature(temperature):
-    if not (0.0 <= temperature <= 1.0):
-        raise ValueError("Temperature must be between 0.0 and 1.0")
-
-def validate_max_tokens(max_tokens):
-    if not (1 <= max_tokens <= 131072):
-        raise ValueError("Max tokens must be between 1 and 131072")
-
-def validate_citation_mode(citation_mode):
-    if citation_mode not in ['fast', 'accurate']:
-        raise ValueError("Citation mode must be either 'fast' or 'accurate'")
-
-def validate_tools(tools):
-    for tool in tools:
-        if 'name' not in tool:
-            raise ValueError("Each tool must have a 'name' field")
-        if 'description' not in tool:
-            raise ValueError("Each tool must have a 'description' field")
-        if 'parameter_definitions' not in tool:
-            raise ValueError("Each tool must have a 'parameter_definitions' field")
-        for param_name, param_def in tool['parameter_definitions'].items():
-            if 'description' not in param_def:
-                raise ValueError(f"Parameter '{param_name}' must have a 'description' field")
-            if 'type' not in param_def:
-                raise ValueError(f"Parameter '{param_name}' must have a 'type' field")
-            if 'required' not in param_def:
-                raise ValueError(f"Parameter '{param_name}' must have a 'required' field")
+DEFAULT_MODEL = 'mlx-community/c4ai-command-r-v01-4bit'
+
+# Printing every generated token to stdout is costly on long generations, so it is opt-in.
+VERBOSE_GENERATE = os.environ.get('MLX_VERBOSE_GENERATE') == '1'
+
+model = None
+tokenizer = None
+draft_model = None
+
+NUM_DRAFT_TOKENS = 4
+
+QUANTIZED_MODELS_DIR = Path(os.environ.get('MLX_QUANTIZED_MODELS_DIR', '~/.cache/command-r-mlx')).expanduser()
+QUANTIZE_GROUP_SIZE = 64
+
+CACHE_LIMIT_GB = 2
+
+_settings = {}
+_initialize_lock = threading.Lock()
+_initialized = False
+
+# Generation runs on a single GPU, so by default only one request generates at a time while
+# request parsing, template rendering and cache lookups of other requests proceed in parallel.
+_generation_semaphore = threading.BoundedSemaphore(1)
+
+CACHE_MAXSIZE = 1024
+CACHE_TTL = 3600
+CACHE_STATS_INTERVAL = 100
+CACHE_DISABLED = os.environ.get('DISABLE_LLM_CACHE') == '1'
+
+_cache = TTLCache(maxsize=CACHE_MAXSIZE, ttl=CACHE_TTL)
+_cache_lock = threading.Lock()
+_hits = 0
+_misses = 0
+_semantic_hits = 0
+
+SEMANTIC_CACHE_MODEL = 'sentence-transformers/all-MiniLM-L6-v2'
+SEMANTIC_CACHE_MAXSIZE = 4096
+SEMANTIC_CACHE_THRESHOLD = 0.95
+
+semantic_cache = None
+
+TEMPLATE_CACHE_MAXSIZE = 4096
+
+# Stand-in for document values when rendering the grounded-generation template, see _rag_skeleton.
+_DOCUMENT_PLACEHOLDER = f"\x00{uuid.uuid4().hex}:%d\x00"
+_DOCUMENT_PLACEHOLDER_PATTERN = re.compile(_DOCUMENT_PLACEHOLDER.replace("%d", r"(\d+)"))
+
+# Each cached token holds keys and values for every layer (about 1.3 MB in fp16 for
+# c4ai-command-r-v01), so the session store is bounded by its total number of tokens.
+SESSION_MAX_TOKENS = 8192
+SESSION_TTL = 600
+
+_sessions = OrderedDict()
+_sessions_lock = threading.Lock()
+
+# Token IDs and KV cache of the fixed preamble of the tool-use and grounded-generation
+# templates, computed once at startup (see _build_prefix_caches).
+_prefix_caches = {}
+
+BATCH_SIZE = 8
+
+# How often a request waiting on the batch scheduler checks that its worker thread is alive.
+BATCH_WORKER_CHECK_INTERVAL = 1.0
+
+batch_scheduler = None
+
+def _compile_schema(schema):
+    """
+    Compile a JSON Schema into a validator that fills in defaults and raises ValueError on invalid data.
+    """
+    validate = fastjsonschema.compile(schema)
+
+    def validator(data):
+        try:
+            return validate(data)
+        except fastjsonschema.JsonSchemaException as e:
+            raise ValueError(e.message) from e
+
+    return validator
+
+CONVERSATION_SCHEMA = {"type": "array", "items": {"type": "object"}}
+
+TOOLS_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "required": ["name", "description", "parameter_definitions"],
+        "properties": {
+            "name": {"type": "string"},
+            "description": {"type": "string"},
+            "parameter_definitions": {
+                "type": "object",
+                "additionalProperties": {
+                    "type": "object",
+                    "required": ["description", "type", "required"],
+                },
+            },
+        },
+    },
+}
+
+MAX_TOKENS_DEFAULT = 1024
+MAX_TOKENS_LIMIT = 131072
+
+def compile_generation_validators(max_tokens_limit=MAX_TOKENS_LIMIT):
+    """
+    (Re)compile the /generate and /chat validators, bounding max_tokens by the given limit.
+    """
+    global validate_generate_request, validate_chat_request
+
+    properties = {
+        "temperature": {"type": "number", "minimum": 0.0, "maximum": 1.0, "default": 0.2},
+        "max_tokens": {"type": "integer", "minimum": 1, "maximum": max_tokens_limit, "default": min(MAX_TOKENS_DEFAULT, max_tokens_limit)},
+        "stream": {"type": "boolean", "default": False},
+    }
+
+    validate_generate_request = _compile_schema({
+        "type": "object",
+        "required": ["prompt"],
+        "properties": {"prompt": {"type": "string"}, **properties},
+    })
+
+    validate_chat_request = _compile_schema({
+        "type": "object",
+        "required": ["conversation"],
+        "properties": {
+            "conversation": CONVERSATION_SCHEMA,
+            "session_id": {"type": "string"},
+            **properties,
+        },
+    })
+
+compile_generation_validators()
+
+validate_tool_request = _compile_schema({
+    "type": "object",
+    "required": ["conversation", "tools"],
+    "properties": {"conversation": CONVERSATION_SCHEMA, "tools": TOOLS_SCHEMA},
+})
+
+RAG_MAX_DOCUMENTS = 8
+
+validate_rag_request = _compile_schema({
+    "type": "object",
+    "required": ["conversation", "documents"],
+    "properties": {
+        "conversation": CONVERSATION_SCHEMA,
+        "documents": {"type": "array", "items": {"type": "object"}},
+        "citation_mode": {"enum": ["fast", "accurate"], "default": "accurate"},
+        "max_documents": {"type": "integer", "minimum": 1, "default": RAG_MAX_DOCUMENTS},
+    },
+})
+
+class SemanticCache:
+    """
+    Embedding-similarity cache that serves the response of a previously seen prompt
+    when the cosine similarity between the two prompts reaches the threshold.
+
+    Embeddings are L2-normalized and stored in a preallocated (maxsize, dim) matrix,
+    so a lookup is a single matrix-vector product. Once full, the oldest entry is
+    overwritten (FIFO eviction).
+    """
+
+    def __init__(self, embedder, maxsize=SEMANTIC_CACHE_MAXSIZE, threshold=SEMANTIC_CACHE_THRESHOLD):
+        self.embedder = embedder
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self._embeddings = np.zeros((maxsize, embedder.get_sentence_embedding_dimension()), dtype=np.float32)
+        self._max_tokens = np.zeros(maxsize, dtype=np.int64)
+        self._responses = [None] * maxsize
+        self._size = 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def embed(self, prompt):
+        """
+        Return the normalized embedding of the prompt, or None when the prompt is longer than
+        the embedder's context (it would be truncated and near-duplicates could not be told apart).
+        """
+        if len(self.embedder.tokenizer.encode(prompt)) > self.embedder.max_seq_length:
+            return None
+        return self.embedder.encode(prompt, normalize_embeddings=True).astype(np.float32)
+
+    def get(self, embedding, max_tokens):
+        with self._lock:
+            if self._size == 0:
+                return None
+            scores = self._embeddings[:self._size] @ embedding
+            scores[self._max_tokens[:self._size] != max_tokens] = -1.0
+            best = int(np.argmax(scores))
+            if scores[best] >= self.threshold:
+                return self._responses[best]
+        return None
+
+    def put(self, embedding, max_tokens, response):
+        with self._lock:
+            self._embeddings[self._next] = embedding
+            self._max_tokens[self._next] = max_tokens
+            self._responses[self._next] = response
+            self._next = (self._next + 1) % self.maxsize
+            self._size = min(self._size + 1, self.maxsize)
+
+def _cache_key(prompt_tokens, temperature, max_tokens):
+    digest = hashlib.blake2b(np.asarray(prompt_tokens, dtype=np.uint32).tobytes()).digest()
+    return digest + struct.pack("fI", temperature, max_tokens)
+
+def _cache_enabled():
+    return not CACHE_DISABLED and request.args.get('no_cache') != '1'
+
+def _to_json(obj):
+    # The templates are rendered from the decoded key, so keys keep their order: sorting would
+    # reorder e.g. a tool's parameter_definitions in the rendered signature.
+    return orjson.dumps(obj)
+
+@lru_cache(maxsize=TEMPLATE_CACHE_MAXSIZE)
+def _apply_chat(conversation_json):
+    return tuple(tokenizer.apply_chat_template(
+        orjson.loads(conversation_json),
+        tokenize=True,
+        add_generation_prompt=True,
+    ))
+
+@lru_cache(maxsize=TEMPLATE_CACHE_MAXSIZE)
+def _apply_tool(conversation_json, tools_json):
+    return tuple(tokenizer.apply_tool_use_template(
+        orjson.loads(conversation_json),
+        tools=orjson.loads(tools_json),
+        tokenize=True,
+        add_generation_prompt=True,
+    ))
+
+@lru_cache(maxsize=TEMPLATE_CACHE_MAXSIZE)
+def _encode_text(text):
+    return tuple(tokenizer.encode(text, add_special_tokens=False))
+
+def _encode_batch(texts):
+    # A batch call on the fast tokenizer encodes the texts in parallel in Rust.
+    if not texts:
+        return []
+    return tokenizer._tokenizer(texts, add_special_tokens=False)["input_ids"]
+
+@lru_cache(maxsize=TEMPLATE_CACHE_MAXSIZE)
+def _rag_skeleton(conversation_json, document_keys, citation_mode):
+    """
+    Render the grounded-generation template with placeholders in place of the document values
+    and tokenize the text around them.
+
+    Returns the token IDs of the fixed segments and, for each placeholder between two segments,
+    the (document index, key, leading whitespace) of the value that goes there. The whitespace
+    before a placeholder (e.g. the space in "title: ") is moved to the value: byte-level BPE
+    encodes a word together with its leading space, so this keeps the spliced tokens equal
+    to those of the rendered prompt.
+    """
+    placeholders = []
+    documents = []
+    for index, keys in enumerate(document_keys):
+        document = {}
+        for key in keys:
+            document[key] = _DOCUMENT_PLACEHOLDER % len(placeholders)
+            placeholders.append((index, key))
+        documents.append(document)
+
+    rendered = tokenizer.apply_grounded_generation_template(
+        orjson.loads(conversation_json),
+        documents=documents,
+        citation_mode=citation_mode,
+        tokenize=False,
+        add_generation_prompt=True,
+    )
+
+    # Splitting on the capturing pattern alternates fixed text and placeholder numbers.
+    parts = _DOCUMENT_PLACEHOLDER_PATTERN.split(rendered)
+    texts = parts[0::2]
+    values = []
+    for i, part in enumerate(parts[1::2]):
+        stripped = texts[i].rstrip()
+        values.append((*placeholders[int(part)], texts[i][len(stripped):]))
+        texts[i] = stripped
+    segments = [_encode_text(text) for text in texts]
+    return segments, values
+
+def _rag_tokens(conversation, documents, citation_mode):
+    """
+    Tokenize the grounded-generation prompt: the document values are tokenized in one batch
+    and spliced between the pretokenized segments of the template.
+    """
+    segments, values = _rag_skeleton(
+        _to_json(conversation),
+        tuple(tuple(document) for document in documents),
+        citation_mode,
+    )
+    value_tokens = _encode_batch(
+        [whitespace + str(documents[index][key]) for index, key, whitespace in values],
+    )
+
+    tokens = list(segments[0])
+    for value, segment in zip(value_tokens, segments[1:]):
+        tokens.extend(value)
+        tokens.extend(segment)
+    return tuple(tokens)
+
+def _bm25_tokens(text):
+    return text.lower().split()
+
+def _select_documents(conversation, documents, max_documents):
+    """
+    Keep the max_documents documents that best match the last user turn according to BM25,
+    in their original order. All documents are kept when there is no user turn to match
+    or no document has any terms to score.
+    """
+    if len(documents) <= max_documents:
+        return documents
+
+    query = next(
+        (turn.get('content') for turn in reversed(conversation) if str(turn.get('role', '')).lower() == 'user'),
+        None,
+    )
+    if not query:
+        return documents
+
+    corpus = [_bm25_tokens(" ".join(str(value) for value in doc.values())) for doc in documents]
+    # BM25Okapi divides by the average document length, which is zero for an empty corpus.
+    if not any(corpus):
+        return documents
+
+    bm25 = BM25Okapi(corpus)
+    scores = bm25.get_scores(_bm25_tokens(str(query)))
+    selected = sorted(np.argsort(-scores, kind='stable')[:max_documents])
+    return [documents[i] for i in selected]
+
+def _common_prefix_length(a, b):
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+def _evict_sessions():
+    """
+    Drop sessions unused for longer than the session TTL, then the least recently used
+    ones until the sessions hold at most the session token limit. Called with _sessions_lock held.
+    """
+    now = time.monotonic()
+    for session_id, (_, _, last_used) in list(_sessions.items()):
+        if now - last_used > _settings['session_ttl']:
+            del _sessions[session_id]
+
+    total_tokens = sum(len(tokens) for tokens, _, _ in _sessions.values())
+    while total_tokens > _settings['session_max_tokens']:
+        tokens, _, _ = _sessions.popitem(last=False)[1]
+        total_tokens -= len(tokens)
+
+def _encode(prompt):
+    # Raw prompts that already start with the BOS token must not get a second one.
+    add_special_tokens = tokenizer.bos_token is None or not prompt.startswith(tokenizer.bos_token)
+    return tuple(tokenizer.encode(prompt, add_special_tokens=add_special_tokens))
+
+def _session_stream(session_id, prompt_tokens, temperature, max_tokens):
+    """
+    Generate a response reusing the KV cache kept for the session, so that only the tokens
+    after the longest common prefix with the session's previous prompt are prefilled.
+
+    Yields the generated text segment by segment. The session is stored back even when the
+    generator is closed early, e.g. because a streaming client disconnected.
+    """
+    tokens = list(prompt_tokens)
+
+    # Take the session out of the store while it is in use so concurrent requests
+    # for the same session cannot corrupt its cache.
+    with _sessions_lock:
+        _evict_sessions()
+        past_tokens, prompt_cache, _ = _sessions.pop(session_id, ([], None, None))
+    if prompt_cache is None:
+        prompt_cache = make_prompt_cache(model)
+
+    # At least one token has to be fed to get logits for the first generated token.
+    prefix_length = min(_common_prefix_length(past_tokens, tokens), len(tokens) - 1)
+    trim_prompt_cache(prompt_cache, len(past_tokens) - prefix_length)
+
+    generated = []
+    try:
+        for response in stream_generate(
+            model,
+            tokenizer,
+            prompt=tokens[prefix_length:],
+            max_tokens=max_tokens,
+            sampler=make_sampler(temp=temperature),
+            prompt_cache=prompt_cache,
+        ):
+            generated.append(response.token)
+            yield response.text
+    finally:
+        # Keep exactly the tokens whose keys and values are held in the cache.
+        cached_tokens = tokens + generated
+        offset = prompt_cache[0].offset
+        if offset > len(cached_tokens):
+            trim_prompt_cache(prompt_cache, offset - len(cached_tokens))
+            offset = len(cached_tokens)
+
+        with _sessions_lock:
+            _sessions[session_id] = (cached_tokens[:offset], prompt_cache, time.monotonic())
+            _evict_sessions()
+
+def make_batch_generator(model, stop_tokens, temperature, batch_size):
+    """
+    Create a BatchGenerator decoding up to batch_size sequences together.
+
+    BatchGenerator only admits waiting prompts once at least prefill_batch_size slots are
+    free, so prompts are prefilled one at a time; otherwise a prompt arriving while others
+    decode would wait for the whole batch to drain.
+    """
+    return BatchGenerator(
+        model,
+        stop_tokens=stop_tokens,
+        sampler=make_sampler(temp=temperature),
+        completion_batch_size=batch_size,
+        prefill_batch_size=1,
+    )
+
+def _build_prefix_caches():
+    """
+    Prefill the preambles that the tool-use and grounded-generation templates render
+    ahead of every conversation, so requests only prefill what comes after them.
+
+    The templates index messages[0], so they are rendered with a single empty user turn;
+    requests only reuse the prefix they share with it. A preamble that fails to render
+    or prefill is skipped, and its requests are generated without a prefix cache.
+    """
+    conversation = [{"role": "user", "content": ""}]
+    renderers = {
+        'tool': lambda: tokenizer.apply_tool_use_template(
+            conversation, tools=[], tokenize=True, add_generation_prompt=True
+        ),
+        'rag': lambda: tokenizer.apply_grounded_generation_template(
+            conversation, documents=[], tokenize=True, add_generation_prompt=True
+        ),
+    }
+    for name, render in renderers.items():
+        try:
+            prefix_tokens = render()
+            prompt_cache = make_prompt_cache(model)
+            model(mx.array(prefix_tokens)[None], cache=prompt_cache)
+            mx.eval([c.state for c in prompt_cache])
+        except Exception as e:
+            logger.warning("Skipping the %s prefix cache: %s", name, e)
+            continue
+        _prefix_caches[name] = (list(prefix_tokens), prompt_cache)
+
+def _copy_prompt_cache(prompt_cache, length):
+    # Slicing gives the copy its own arrays, so generating on top of it leaves the original intact.
+    copy = make_prompt_cache(model)
+    for target, source in zip(copy, prompt_cache):
+        keys, values = source.state
+        target.state = (keys[..., :length, :], values[..., :length, :])
+    return copy
+
+def _prefix_generate(prefix, prompt_tokens, temperature, max_tokens):
+    """
+    Generate a response starting from a copy of the precomputed KV cache of the named
+    preamble, prefilling only the tokens that differ from it.
+    """
+    prefix_tokens, prefix_cache = _prefix_caches[prefix]
+
+    # At least one token has to be fed to get logits for the first generated token.
+    prefix_length = min(_common_prefix_length(prefix_tokens, prompt_tokens), len(prompt_tokens) - 1)
+
+    segments = []
+    for response in stream_generate(
+        model,
+        tokenizer,
+        prompt=list(prompt_tokens[prefix_length:]),
+        max_tokens=max_tokens,
+        sampler=make_sampler(temp=temperature),
+        prompt_cache=_copy_prompt_cache(prefix_cache, prefix_length),
+    ):
+        segments.append(response.text)
+
+    return "".join(segments)
+
+class BatchScheduler:
+    """
+    Continuous batching of concurrent generation requests.
+
+    Handler threads queue their prompts and wait on a future. A single worker thread inserts
+    queued prompts into mlx_lm BatchGenerators and decodes all active sequences together, one
+    batched forward pass per step, resolving each future as soon as its sequence finishes.
+    The sampler is fixed per BatchGenerator, so there is one generator per temperature.
+    """
+
+    def __init__(self, batch_size=BATCH_SIZE):
+        self.batch_size = batch_size
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='batch-scheduler', daemon=True)
+        self._thread.start()
+
+    def generate(self, prompt_tokens, temperature, max_tokens):
+        future = Future()
+        self._queue.put((prompt_tokens, temperature, max_tokens, future))
+        # Wait in intervals, so that a dead worker thread fails the request instead of hanging it.
+        while True:
+            if not self._thread.is_alive():
+                raise RuntimeError("The batch scheduler thread is not running")
+            try:
+                return future.result(timeout=BATCH_WORKER_CHECK_INTERVAL)
+            except FutureTimeoutError:
+                pass
+
+    def _run(self):
+        generators = {}
+        pending = {}
+
+        while True:
+            # Block only when there is nothing to decode.
+            items = []
+            try:
+                items.append(self._queue.get(block=not pending))
+                while True:
+                    items.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            for prompt_tokens, temperature, max_tokens, future in items:
+                try:
+                    if temperature not in generators:
+                        generators[temperature] = make_batch_generator(
+                            model,
+                            set(tokenizer.eos_token_ids),
+                            temperature,
+                            self.batch_size,
+                        )
+                    (uid,) = generators[temperature].insert([list(prompt_tokens)], [max_tokens])
+                    pending[(temperature, uid)] = (future, [])
+                except Exception as e:
+                    future.set_exception(e)
+
+            for temperature, generator in list(generators.items()):
+                # Any failure fails this generator's requests, and must not kill the worker thread.
+                try:
+                    with _generation_semaphore:
+                        responses = generator.next()
+
+                    for response in responses:
+                        future, tokens = pending[(temperature, response.uid)]
+                        if response.finish_reason != 'stop':
+                            tokens.append(response.token)
+                        if response.finish_reason is not None:
+                            text = tokenizer.decode(tokens)
+                            del pending[(temperature, response.uid)]
+                            future.set_result(text)
+
+                    # Release the caches of generators that have nothing left to decode.
+                    if not any(key[0] == temperature for key in pending):
+                        del generators[temperature]
+                except Exception as e:
+                    logger.error("Batched generation failed: %s", e)
+                    for key in [key for key in pending if key[0] == temperature]:
+                        pending.pop(key)[0].set_exception(e)
+                    generators.pop(temperature, None)
+
+def _cache_lookup(prompt_tokens, temperature, max_tokens):
+    """
+    Look the request up in the response cache and, for deterministic requests, in the semantic cache.
+
+    Returns a (cached_response, embedding) tuple; on a miss, the embedding (if any) is to be
+    passed on to _cache_store along with the generated response.
+    """
+    global _hits, _misses, _semantic_hits
+
+    key = _cache_key(prompt_tokens, temperature, max_tokens)
+    with _cache_lock:
+        cached = _cache.get(key)
+        if cached is not None:
+            _hits += 1
+        else:
+            _misses += 1
+        hits, misses = _hits, _misses
+
+    if (hits + misses) % CACHE_STATS_INTERVAL == 0:
+        logger.info("Response cache: %d hits, %d misses, %d semantic hits", hits, misses, _semantic_hits)
+
+    if cached is not None:
+        return cached, None
+
+    # Near-duplicate lookup only makes sense for deterministic generations.
+    embedding = None
+    if semantic_cache is not None and temperature == 0:
+        embedding = semantic_cache.embed(tokenizer.decode(prompt_tokens))
+        if embedding is not None:
+            cached = semantic_cache.get(embedding, max_tokens)
+            if cached is not None:
+                with _cache_lock:
+                    _semantic_hits += 1
+
+    return cached, embedding
+
+def _cache_store(prompt_tokens, temperature, max_tokens, embedding, response):
+    with _cache_lock:
+        _cache[_cache_key(prompt_tokens, temperature, max_tokens)] = response
+    if embedding is not None:
+        semantic_cache.put(embedding, max_tokens, response)
+
+def _cached_generate(prompt_tokens, temperature=0.0, max_tokens=100, session_id=None, prefix=None):
+    """
+    Generate a response for the prompt tokens, serving repeated (prompt, temperature, max_tokens)
+    requests from the in-memory response cache.
+
+    When a session_id is given, a cache miss is generated on top of the session's KV cache
+    (see _session_stream), and when a prefix is given, on top of that template preamble's
+    precomputed KV cache (see _prefix_generate). Otherwise it is batched with concurrent
+    requests when the batch scheduler is enabled.
+
+    The defaults match those of mlx_lm.generate, which the /tool and /rag endpoints rely on.
+    Caching is skipped when the DISABLE_LLM_CACHE=1 environment variable or the
+    ?no_cache=1 query parameter is set.
+    """
+    use_cache = _cache_enabled()
+    embedding = None
+    if use_cache:
+        cached, embedding = _cache_lookup(prompt_tokens, temperature, max_tokens)
+        if cached is not None:
+            return cached
+
+    if session_id is not None:
+        with _generation_semaphore:
+            response = "".join(_session_stream(session_id, prompt_tokens, temperature, max_tokens))
+    elif prefix in _prefix_caches:
+        with _generation_semaphore:
+            response = _prefix_generate(prefix, prompt_tokens, temperature, max_tokens)
+    elif batch_scheduler is not None:
+        response = batch_scheduler.generate(prompt_tokens, temperature, max_tokens)
+    else:
+        with _generation_semaphore:
+            response = generate(
+                model,
+                tokenizer,
+                prompt=list(prompt_tokens),
+                verbose=VERBOSE_GENERATE,
+                sampler=make_sampler(temp=temperature),
+                max_tokens=max_tokens,
+                **_speculative_kwargs(),
+            )
+
+    if use_cache:
+        _cache_store(prompt_tokens, temperature, max_tokens, embedding, response)
+
+    return response
+
+def _speculative_kwargs():
+    if draft_model is None:
+        return {}
+    return {'draft_model': draft_model, 'num_draft_tokens': _settings['num_draft_tokens']}
+
+def _sse(payload):
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+def _stream_events(prompt_tokens, temperature, max_tokens, session_id=None):
+    """
+    Stream the response as server-sent events: one {"token": ...} event per generated text
+    segment, then a final [DONE] event. A cached response is sent as a single event.
+
+    Errors raised after the response has started are sent as an {"error": ...} event.
+    The semaphore is released as soon as the client disconnects and the server closes
+    the generator.
+    """
+    try:
+        use_cache = _cache_enabled()
+        embedding = None
+        if use_cache:
+            cached, embedding = _cache_lookup(prompt_tokens, temperature, max_tokens)
+            if cached is not None:
+                yield _sse({"token": cached})
+                yield b"data: [DONE]\n\n"
+                return
+
+        segments = []
+        with _generation_semaphore:
+            if session_id is not None:
+                stream = _session_stream(session_id, prompt_tokens, temperature, max_tokens)
+            else:
+                stream = (
+                    response.text
+                    for response in stream_generate(
+                        model,
+                        tokenizer,
+                        prompt=list(prompt_tokens),
+                        max_tokens=max_tokens,
+                        sampler=make_sampler(temp=temperature),
+                        **_speculative_kwargs(),
+                    )
+                )
+            for segment in stream:
+                segments.append(segment)
+                if segment:
+                    yield _sse({"token": segment})
+
+        if use_cache:
+            _cache_store(prompt_tokens, temperature, max_tokens, embedding, "".join(segments))
+
+    except Exception as e:
+        logger.error("An error occurred: %s", e)
+        yield _sse({"error": "An unexpected error occurred", "details": str(e)})
+        return
+
+    yield b"data: [DONE]\n\n"
+
+@app.errorhandler(KeyError)
+def _handle_key_error(e):
+    logger.error("Missing key in request JSON: %s", e)
+    return jsonify({"error": f"Missing key in request JSON: {str(e)}"}), 400
+
+@app.errorhandler(ValueError)
+def _handle_value_error(e):
+    logger.error("An error occurred: %s", e)
+    return jsonify({"error": str(e)}), 400
+
+@app.errorhandler(Exception)
+def _handle_exception(e):
+    # Let Flask render its own HTTP errors (404, 405, malformed JSON, ...).
+    if isinstance(e, HTTPException):
+        return e
+    logger.error("An error occurred: %s", e)
+    return jsonify({"error": "An unexpected error occurred", "details": str(e)}), 500
+
+def _stream_response(prompt_tokens, temperature, max_tokens, session_id=None):
+    return Response(
+        stream_with_context(_stream_events(prompt_tokens, temperature, max_tokens, session_id=session_id)),
+        mimetype='text/event-stream',
+    )
 
 @app.route('/generate', methods=['POST'])
 def generate_text():
@@ -43,49 +804,36 @@ def generate_text():
     {
         "prompt": "The prompt to generate text from",
         "temperature": (optional, default=0.2) The temperature for text generation (0.0 to 1.0),
-        "max_tokens": (optional, default=131072) The maximum number of tokens to generate (1 to 131072)
+        "max_tokens": (optional, default=1024) The maximum number of tokens to generate (1 to the model's context length),
+        "stream": (optional, default=false) Stream the response as server-sent events
     }
 
     Response JSON:
     {
         "generated_text": "The generated text"
     }
+
+    With "stream": true, the response is a text/event-stream of
+    data: {"token": "..."} events terminated by data: [DONE].
     """
 
     logger.info("Received a generation request.")
 
-    try:
-        data = request.get_json()
-        prompt = data['prompt']
-        temperature = data.get('temperature', 0.2)
-        max_tokens = data.get('max_tokens', 131072)
-        
-        validate_temperature(temperature)
-        validate_max_tokens(max_tokens)
-        
-        response = generate(
-            model, 
-            tokenizer,
-            prompt=prompt,
-            verbose=True,
-            temp=temperature,
-            max_tokens=max_tokens,
-        )
-
-        logger.debug(f"Generated response: {response}")
-        return jsonify({"generated_text": response})
-    
-    except KeyError as e:
-        logger.error(f"Missing key in request JSON: {str(e)}")
-        return jsonify({"error": f"Missing key in request JSON: {str(e)}"}), 400
+    data = validate_generate_request(request.get_json())
+    prompt = data['prompt']
+    temperature = data['temperature']
+    # The schema's "integer" also accepts integral floats such as 100.0.
+    max_tokens = int(data['max_tokens'])
     
-    except ValueError as e:
-        logger.error(f"An error occurred: {str(e)}")
-        return jsonify({"error": str(e)}), 400
-    
-    except Exception as e:
-        logger.error(f"An error occurred: {str(e)}")
-        return jsonify({"error": "An unexpected error occurred", "details": str(e)}), 500
+    prompt_tokens = _encode(prompt)
+
+    if data['stream']:
+        return _stream_response(prompt_tokens, temperature, max_tokens)
+
+    response = _cached_generate(prompt_tokens, temperature, max_tokens)
+
+    logger.debug("Generated response: %s", response)
+    return jsonify({"generated_text": response})
 
 @app.route('/chat', methods=['POST'])
 def chat():
@@ -100,44 +848,34 @@ def chat():
             ...
         ],
         "temperature": (optional, default=0.2) The temperature for response generation (0.0 to 1.0),
-        "max_tokens": (optional, default=131072) The maximum number of tokens to generate (1 to 131072)
+        "max_tokens": (optional, default=1024) The maximum number of tokens to generate (1 to the model's context length),
+        "session_id": (optional) An identifier of the conversation; the KV cache of its previous turns is reused,
+        "stream": (optional, default=false) Stream the response as server-sent events
     }
 
     Response JSON:
     {
         "generated_text": "The generated chat response"
     }
-    """
-    try:
-        data = request.get_json()
-        conversation = data['conversation']
-        temperature = data.get('temperature', 0.2)
-        max_tokens = data.get('max_tokens', 131072)
-        
-        validate_temperature(temperature)
-        validate_max_tokens(max_tokens)
-        
-        inputs = tokenizer.apply_chat_template(conversation, tokenize=False, add_generation_prompt=True)
-        
-        response = generate(
-            model, 
-            tokenizer,
-            prompt=inputs,
-            verbose=True,
-            temp=temperature,
-            max_tokens=max_tokens,
-        )
 
-        return jsonify({"generated_text": response})
-    
-    except KeyError as e:
-        return jsonify({"error": f"Missing key in request JSON: {str(e)}"}), 400
+    With "stream": true, the response is a text/event-stream of
+    data: {"token": "..."} events terminated by data: [DONE].
+    """
+    data = validate_chat_request(request.get_json())
+    conversation = data['conversation']
+    temperature = data['temperature']
+    # The schema's "integer" also accepts integral floats such as 100.0.
+    max_tokens = int(data['max_tokens'])
+    session_id = data.get('session_id')
     
-    except ValueError as e:
-        return jsonify({"error": str(e)}), 400
+    prompt_tokens = _apply_chat(_to_json(conversation))
     
-    except Exception as e:
-        return jsonify({"error": "An unexpected error occurred", "details": str(e)}), 500
+    if data['stream']:
+        return _stream_response(prompt_tokens, temperature, max_tokens, session_id=session_id)
+
+    response = _cached_generate(prompt_tokens, temperature, max_tokens, session_id=session_id)
+
+    return jsonify({"generated_text": response})
 
 @app.route('/tool', methods=['POST'])
 def use_tool():
@@ -174,30 +912,15 @@ def use_tool():
 
     logger.info("Received a tool request.")
 
-    try:
-        data = request.get_json()
-        conversation = data['conversation']
-        tools = data['tools']
-        
-        validate_tools(tools)
-        
-        formatted_input = tokenizer.apply_tool_use_template(conversation, tools=tools, tokenize=False, add_generation_prompt=True)
-        
-        response = generate(model, tokenizer, prompt=formatted_input, verbose=True)
-
-        return jsonify({"tool_response": response})
+    data = validate_tool_request(request.get_json())
+    conversation = data['conversation']
+    tools = data['tools']
     
-    except KeyError as e:
-        logger.error(f"Missing key in request JSON: {str(e)}")
-        return jsonify({"error": f"Missing key in request JSON: {str(e)}"}), 400
+    prompt_tokens = _apply_tool(_to_json(conversation), _to_json(tools))
     
-    except ValueError as e:
-        logger.error(f"An error occurred: {str(e)}")
-        return jsonify({"error": str(e)}), 400
-    
-    except Exception as e:
-        logger.error(f"An error occurred: {str(e)}")
-        return jsonify({"error": "An unexpected error occurred", "details": str(e)}), 500
+    response = _cached_generate(prompt_tokens, prefix='tool')
+
+    return jsonify({"tool_response": response})
 
 @app.route('/rag', methods=['POST'])
 def rag():
@@ -215,7 +938,8 @@ def rag():
             { "title": "Tall penguins", "text": "Emperor penguins are the tallest growing up to 122 cm in height." }, 
             { "title": "Penguin habitats", "text": "Emperor penguins only live in Antarctica."}
         ],
-        "citation_mode": (optional, default="accurate") The citation mode ("fast" or "accurate")
+        "citation_mode": (optional, default="accurate") The citation mode ("fast" or "accurate"),
+        "max_documents": (optional, default=8) The number of documents most relevant to the last user turn to ground the response on
     }
 
     Response JSON:
@@ -226,45 +950,242 @@ def rag():
 
     logger.info("Received a RAG request.")
 
-    try:
-        data = request.get_json()
-        conversation = data['conversation']
-        documents = data['documents']
-        citation_mode = data.get('citation_mode', 'accurate')
-        
-        validate_citation_mode(citation_mode)
-        
-        formatted_input = tokenizer.apply_grounded_generation_template(
-            conversation,
-            documents=documents,
-            citation_mode=citation_mode,
-            tokenize=False,
-            add_generation_prompt=True,
-        )
-        
-        response = generate(model, tokenizer, prompt=formatted_input, verbose=True)
-
-        return jsonify({"rag_response": response})
-    
-    except KeyError as e:
-        logger.error(f"Missing key in request JSON: {str(e)}")
-        return jsonify({"error": f"Missing key in request JSON: {str(e)}"}), 400
+    data = validate_rag_request(request.get_json())
+    conversation = data['conversation']
+    documents = _select_documents(conversation, data['documents'], int(data['max_documents']))
+    citation_mode = data['citation_mode']
     
-    except ValueError as e:
-        logger.error(f"An error occurred: {str(e)}")
-        return jsonify({"error": str(e)}), 400
+    prompt_tokens = _rag_tokens(conversation, documents, citation_mode)
     
-    except Exception as e:
-        logger.error(f"An error occurred: {str(e)}")
-        return jsonify({"error": "An unexpected error occurred", "details": str(e)}), 500
+    response = _cached_generate(prompt_tokens, prefix='rag')
+
+    return jsonify({"rag_response": response})
+
+def _context_length(model_name):
+    """
+    Return the model's context length: the larger of max_position_embeddings in its config.json
+    (mlx_lm's ModelArgs drop it for Command-R, so it cannot be taken from the loaded model) and
+    the tokenizer's model_max_length. c4ai-command-r-v01's config lists 8192 while the model,
+    and its tokenizer, support 128k tokens.
+    """
+    model_path = get_model_path(model_name)
+    # Newer mlx_lm versions return (path, hf_repo).
+    if isinstance(model_path, tuple):
+        model_path = model_path[0]
+    lengths = [
+        load_config(model_path).get('max_position_embeddings'),
+        getattr(tokenizer, 'model_max_length', None),
+    ]
+    length = max((length for length in lengths if isinstance(length, int)), default=MAX_TOKENS_LIMIT)
+    return min(length, MAX_TOKENS_LIMIT)
+
+def configure_json_logging():
+    """
+    Emit all log records, including the application's, as JSON lines on stderr.
+    """
+    handler = logging.StreamHandler()
+    handler.setFormatter(JSONFormatter())
+    logging.root.handlers = [handler]
+    logger.removeHandler(default_handler)
+
+def _quantized_model_path(model_name, bits, group_size):
+    """
+    Return the path of the model quantized to the given bits and group size, converting it
+    on first use. The embedding (which Command-R also uses as its output projection) is
+    kept at 4 bits, as it is the most sensitive to quantization.
+    """
+    path = QUANTIZED_MODELS_DIR / f"{model_name.replace('/', '--')}-{bits}bit-g{group_size}"
+    if path.exists():
+        return str(path)
+
+    from mlx_lm import convert
+
+    def quant_predicate(layer_path, module, config=None):
+        if not hasattr(module, 'to_quantized'):
+            return False
+        if 'embed_tokens' in layer_path or 'lm_head' in layer_path:
+            return {'bits': max(bits, 4), 'group_size': group_size}
+        return True
+
+    logger.info("Quantizing %s to %d bits with group size %d", model_name, bits, group_size)
+    # Convert into a temporary directory so an interrupted conversion is not mistaken for a finished one.
+    tmp_path = path.with_name(path.name + '.tmp')
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    convert(
+        model_name,
+        mlx_path=str(tmp_path),
+        quantize=True,
+        q_bits=bits,
+        q_group_size=group_size,
+        quant_predicate=quant_predicate,
+    )
+    tmp_path.rename(path)
+    return str(path)
+
+@lru_cache(maxsize=1)
+def _get_model(model_name):
+    return load(model_name)
+
+@lru_cache(maxsize=1)
+def _get_draft_model(model_name):
+    return load(model_name)
+
+def _initialize():
+    """
+    Load the model and set up everything that depends on it, once per process.
+    """
+    global model, tokenizer, draft_model, semantic_cache, batch_scheduler, _generation_semaphore, _initialized
+
+    with _initialize_lock:
+        if _initialized:
+            return
+
+        model_name = _settings['model_name']
+        if _settings['quantize_bits'] is not None:
+            model_name = _quantized_model_path(model_name, _settings['quantize_bits'], _settings['quantize_group_size'])
+
+        if _settings['cache_limit_gb'] is not None:
+            mx.set_cache_limit(int(_settings['cache_limit_gb'] * (1 << 30)))
+        if _settings['memory_limit_gb'] is not None:
+            mx.set_memory_limit(int(_settings['memory_limit_gb'] * (1 << 30)))
+
+        model, tokenizer = _get_model(model_name)
+        _generation_semaphore = threading.BoundedSemaphore(_settings['concurrency'])
+        compile_generation_validators(_context_length(model_name))
+        _build_prefix_caches()
+
+        # Compile the decoding kernels now rather than on the first request.
+        generate(model, tokenizer, prompt="warmup", max_tokens=4, verbose=False)
+
+        # The draft model shares the main model's tokenizer. Speculative decoding runs one
+        # sequence at a time, so it takes the place of batching.
+        if _settings['draft_model_name'] is not None:
+            draft_model, _ = _get_draft_model(_settings['draft_model_name'])
+        elif _settings['batch_size'] > 1:
+            batch_scheduler = BatchScheduler(_settings['batch_size'])
+
+        if _settings['use_semantic_cache']:
+            from sentence_transformers import SentenceTransformer
+            semantic_cache = SemanticCache(SentenceTransformer(SEMANTIC_CACHE_MODEL))
+
+        _initialized = True
+
+@app.before_request
+def _ensure_initialized():
+    if not _initialized:
+        # The app was imported without create_app (e.g. `gunicorn server:app` or `flask run`),
+        # so it runs with create_app's defaults.
+        if not _settings:
+            create_app(lazy=True)
+        _initialize()
+
+def create_app(
+    model_name=DEFAULT_MODEL,
+    concurrency=1,
+    batch_size=BATCH_SIZE,
+    use_semantic_cache=False,
+    draft_model_name=None,
+    num_draft_tokens=NUM_DRAFT_TOKENS,
+    quantize_bits=None,
+    quantize_group_size=QUANTIZE_GROUP_SIZE,
+    session_max_tokens=SESSION_MAX_TOKENS,
+    session_ttl=SESSION_TTL,
+    cache_limit_gb=CACHE_LIMIT_GB,
+    memory_limit_gb=None,
+    json_logs=False,
+    lazy=False,
+):
+    """
+    Configure and return the Flask application, loading the model right away unless lazy is set,
+    in which case it is loaded by the first request. With json_logs, logs are emitted as JSON lines.
+
+    This is the entry point for WSGI servers, e.g.:
+        gunicorn --workers 1 --threads 8 'server:create_app()'
+
+    The model must be loaded in the worker process (do not use gunicorn's --preload),
+    since Metal resources do not survive a fork.
+    """
+    _settings.update(
+        model_name=model_name,
+        concurrency=concurrency,
+        batch_size=batch_size,
+        use_semantic_cache=use_semantic_cache,
+        draft_model_name=draft_model_name,
+        num_draft_tokens=num_draft_tokens,
+        quantize_bits=quantize_bits,
+        quantize_group_size=quantize_group_size,
+        session_max_tokens=session_max_tokens,
+        session_ttl=session_ttl,
+        cache_limit_gb=cache_limit_gb,
+        memory_limit_gb=memory_limit_gb,
+    )
+    if json_logs:
+        configure_json_logging()
+    if not lazy:
+        _initialize()
+    return app
+
+def serve(host, port, threads, **app_kwargs):
+    """
+    Serve the application with gunicorn, using a single worker that handles requests in threads.
+
+    gunicorn is exec'd with the app factory rather than run from this process, so that MLX is
+    only imported in the worker: importing mlx_lm already creates a Metal stream, which would
+    not survive the fork.
+    """
+    factory = "server:create_app(%s)" % ", ".join(f"{key}={value!r}" for key, value in app_kwargs.items())
+    os.execv(sys.executable, [
+        sys.executable, '-m', 'gunicorn',
+        '--chdir', os.path.dirname(os.path.abspath(__file__)),
+        '--bind', f"{host}:{port}",
+        '--workers', '1',
+        '--worker-class', 'gthread',
+        '--threads', str(threads),
+        # Generations can take minutes, so never kill a busy worker.
+        '--timeout', '0',
+        factory,
+    ])
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Run the Command-R MLX API server')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Host address for the server')
     parser.add_argument('--port', '-p', type=int, default=5000, help='Port number for the server')
-    parser.add_argument('--model', '-m', type=str, default='mlx-community/c4ai-command-r-v01-4bit', help='Model name')
-    parser.add_argument('--debug', '-d', action='store_true', default=True, help='Enable debug mode')
+    parser.add_argument('--model', '-m', type=str, default=DEFAULT_MODEL, help='Model name')
+    parser.add_argument('--debug', '-d', action='store_true', help='Run the Flask development server in debug mode')
+    parser.add_argument('--threads', type=int, default=8, help='Number of request handling threads')
+    parser.add_argument('--concurrency', type=int, default=1, help='Maximum number of concurrent generations')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Maximum number of requests decoded together (1 disables batching)')
+    parser.add_argument('--semantic-cache', action='store_true', help='Serve near-duplicate prompts from an embedding-similarity cache')
+    parser.add_argument('--draft-model', type=str, default=None, help='Small model sharing the tokenizer, used for speculative decoding')
+    parser.add_argument('--num-draft-tokens', type=int, default=NUM_DRAFT_TOKENS, help='Number of tokens drafted per speculative decoding step')
+    parser.add_argument('--quantize-bits', type=int, default=None, help='Quantize the (full precision) model to this many bits, caching the result on disk')
+    parser.add_argument('--quantize-group-size', type=int, default=QUANTIZE_GROUP_SIZE, help='Group size used with --quantize-bits')
+    parser.add_argument('--session-max-tokens', type=int, default=SESSION_MAX_TOKENS, help='Total number of tokens whose KV cache is kept across chat sessions')
+    parser.add_argument('--session-ttl', type=int, default=SESSION_TTL, help='Seconds after which an unused chat session is dropped')
+    parser.add_argument('--cache-limit-gb', type=float, default=CACHE_LIMIT_GB, help='Limit of the memory MLX keeps cached for reuse, in GB')
+    parser.add_argument('--memory-limit-gb', type=float, default=None, help='Memory limit for MLX, in GB')
+    parser.add_argument('--json-logs', action='store_true', help='Emit logs as JSON lines')
     args = parser.parse_args()
-    
-    model, tokenizer = load(args.model)
-    
-    app.run(port=args.port, debug=args.debug)
\ No newline at end of file
+
+    app_kwargs = {
+        'model_name': args.model,
+        'concurrency': args.concurrency,
+        'batch_size': args.batch_size,
+        'use_semantic_cache': args.semantic_cache,
+        'draft_model_name': args.draft_model,
+        'num_draft_tokens': args.num_draft_tokens,
+        'quantize_bits': args.quantize_bits,
+        'quantize_group_size': args.quantize_group_size,
+        'session_max_tokens': args.session_max_tokens,
+        'session_ttl': args.session_ttl,
+        'cache_limit_gb': args.cache_limit_gb,
+        'memory_limit_gb': args.memory_limit_gb,
+        'json_logs': args.json_logs,
+    }
+
+    if args.debug:
+        # The reloader runs this script in a watcher process as well; loading lazily
+        # keeps the model out of it.
+        create_app(**app_kwargs, lazy=True).run(host=args.host, port=args.port, debug=True)
+    else:
+        serve(args.host, args.port, args.threads, **app_kwargs)
@@ -0,0 +1,57 @@
+import pytest
+
+pytest.importorskip("flask")
+pytest.importorskip("mlx_lm")
+
+from mlx_lm.models import llama
+
+import server
+
+
+def _tiny_model():
+    args = llama.ModelArgs(
+        model_type="llama",
+        hidden_size=32,
+        num_hidden_layers=2,
+        intermediate_size=64,
+        num_attention_heads=4,
+        rms_norm_eps=1e-5,
+        vocab_size=100,
+        num_key_value_heads=4,
+    )
+    return llama.Model(args)
+
+
+def test_prompt_joins_running_batch():
+    generator = server.make_batch_generator(_tiny_model(), set(), temperature=0.0, batch_size=8)
+
+    (first,) = generator.insert([[1, 2, 3]], [50])
+    for _ in range(3):
+        assert [r.uid for r in generator.next()] == [first]
+
+    (second,) = generator.insert([[4, 5, 6]], [50])
+    responses = generator.next() + generator.next()
+
+    assert second in {r.uid for r in responses}
+    # The first sequence is still decoding, so the second one joined mid-batch.
+    assert all(r.finish_reason is None for r in responses if r.uid == first)
+
+
+class _FailingGenerator:
+    def insert(self, prompts, max_tokens):
+        return [0]
+
+    def next(self):
+        raise RuntimeError("decode failed")
+
+
+def test_generation_failure_fails_request_and_keeps_worker(monkeypatch):
+    monkeypatch.setattr(server, "tokenizer", type("Tokenizer", (), {"eos_token_ids": []})())
+    monkeypatch.setattr(server, "make_batch_generator", lambda *args: _FailingGenerator())
+    scheduler = server.BatchScheduler(batch_size=8)
+
+    for _ in range(2):
+        with pytest.raises(RuntimeError, match="decode failed"):
+            scheduler.generate((1, 2, 3), 0.0, 10)
+
+    assert scheduler._thread.is_alive()
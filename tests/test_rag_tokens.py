@@ -0,0 +1,59 @@
+import re
+
+import pytest
+
+pytest.importorskip("flask")
+pytest.importorskip("mlx_lm")
+
+import server
+
+# GPT-2 style pre-tokenization: words and punctuation keep their leading space.
+_PRE_TOKENIZE = re.compile(r" ?[^\W\d_]+| ?\d+| ?[^\s\w]+|\s+(?!\S)|\s+")
+
+
+class StubTokenizer:
+    """
+    Byte-level BPE stand-in that maps every pre-token to its own ID, so that splitting
+    a word from its leading space changes the IDs.
+    """
+
+    def __init__(self):
+        self.vocab = {}
+        self._tokenizer = self
+
+    def encode(self, text, add_special_tokens=False):
+        return [self.vocab.setdefault(piece, len(self.vocab)) for piece in _PRE_TOKENIZE.findall(text)]
+
+    def __call__(self, texts, add_special_tokens=False):
+        return {"input_ids": [self.encode(text) for text in texts]}
+
+    def apply_grounded_generation_template(self, conversation, documents, citation_mode, tokenize, add_generation_prompt):
+        rendered = "<BOS_TOKEN>" + "".join(f"{turn['role']}: {turn['content']}\n" for turn in conversation)
+        for index, document in enumerate(documents):
+            rendered += f"Document: {index}\n" + "".join(f"{key}: {value}\n" for key, value in document.items())
+        return rendered + f"Citation mode: {citation_mode}"
+
+
+@pytest.fixture
+def stub_tokenizer(monkeypatch):
+    stub = StubTokenizer()
+    monkeypatch.setattr(server, "tokenizer", stub)
+    server._rag_skeleton.cache_clear()
+    server._encode_text.cache_clear()
+    yield stub
+    server._rag_skeleton.cache_clear()
+    server._encode_text.cache_clear()
+
+
+def test_spliced_tokens_match_rendered_prompt(stub_tokenizer):
+    conversation = [{"role": "user", "content": "How tall are emperor penguins?"}]
+    documents = [
+        {"title": "Tall penguins", "text": "Emperor penguins are the tallest growing up to 122 cm in height."},
+        {"title": "Penguin habitats", "text": "Emperor penguins only live in Antarctica."},
+    ]
+
+    rendered = stub_tokenizer.apply_grounded_generation_template(
+        conversation, documents=documents, citation_mode="accurate", tokenize=False, add_generation_prompt=True
+    )
+
+    assert list(server._rag_tokens(conversation, documents, "accurate")) == stub_tokenizer.encode(rendered)